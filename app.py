@@ -1,6 +1,9 @@
+import hashlib
 import os
+import threading
 import uuid
-from io import BytesIO
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
 
 from flask import (
     Flask,
@@ -11,13 +14,25 @@ from flask import (
     send_file,
     session,
 )
+import numpy as np
 import pandas as pd
-from openpyxl.styles import PatternFill
+from xlsxwriter.utility import xl_col_to_name
+
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_READ_ENGINE = "calamine"
+except ImportError:
+    EXCEL_READ_ENGINE = "openpyxl"
 
 # ---------------- BASIC SETUP ----------------
 
 app = Flask(__name__)
 
+# All templates are compiled once at startup into the in-process cache.
+# Template auto-reload follows debug mode, so it is off in production.
+for template_name in app.jinja_env.list_templates(extensions=["html"]):
+    app.jinja_env.get_template(template_name)
+
 # Secret key for sessions (use an env var in production)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-key")
 
@@ -26,9 +41,44 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TMP_DIR = os.path.join(BASE_DIR, "tmp")
 os.makedirs(TMP_DIR, exist_ok=True)
 
+# Upload limits; form fields above 1 MB are rejected and files spill to disk
+app.config["MAX_CONTENT_LENGTH"] = int(
+    os.environ.get("MAX_CONTENT_LENGTH", 50 * 1024 * 1024)
+)
+app.config["MAX_FORM_MEMORY_SIZE"] = 1024 * 1024
+
+# In-process LRU cache of per-job dataframes: {job_id: {name: (version, df)}}
+# Each save_df records a fresh version in the session; a cached frame is
+# only used while its version matches, otherwise the file in TMP_DIR is
+# reread (evicted, or saved again by another worker process).
+MAX_CACHED_JOBS = int(os.environ.get("MAX_CACHED_JOBS", 32))
+JOB_CACHE: "OrderedDict[str, dict[str, tuple[str, pd.DataFrame]]]" = OrderedDict()
+JOB_CACHE_LOCK = threading.Lock()
+
+# Parsed uploads keyed by file content hash, so re-uploading the same
+# workbook skips the Excel parse: {content_hash: df}
+MAX_PARSE_CACHE = int(os.environ.get("MAX_PARSE_CACHE", 16))
+PARSE_CACHE: "OrderedDict[str, pd.DataFrame]" = OrderedDict()
+PARSE_CACHE_LOCK = threading.Lock()
+
+# Cleaned frames keyed by (content_hash, ned_column), so picking the same
+# column again for the same upload skips clean_ned_column
+MAX_CLEAN_CACHE = int(os.environ.get("MAX_CLEAN_CACHE", 32))
+CLEAN_CACHE: "OrderedDict[tuple[str, str], pd.DataFrame]" = OrderedDict()
+CLEAN_CACHE_LOCK = threading.Lock()
+
 
 # --------- Utility: critical cleaning for NED columns ---------
 
+EMPTY_MARKERS = frozenset({"", "nan", "none", "null", "na", "n/a"})
+
+# Arrow-backed strings: hashing, comparisons and unique run in C++
+ARROW_STRING = "string[pyarrow]"
+
+# Any Unicode decimal digit, as Python's \d (Arrow's RE2 \d is ASCII-only)
+DIGIT_PATTERN = r"\p{Nd}"
+
+
 def clean_ned_column(df, col_name):
     """
     Critical cleaning rules for NED Pass Numbers:
@@ -40,13 +90,17 @@ def clean_ned_column(df, col_name):
       * value has no digits at all
       * row lies in the last 15 rows of the file
     """
-    s = df[col_name].astype(str).str.strip()
+    s = df[col_name].astype(ARROW_STRING).str.strip()
 
-    empty_markers = {"", "nan", "none", "null", "na", "n/a"}
-    mask_empty_like = s.str.lower().isin(empty_markers)
+    # Missing cells stay NA on the Arrow string dtype
+    mask_empty_like = (s.str.lower().isin(EMPTY_MARKERS) | s.isna()).to_numpy(
+        dtype=bool, na_value=True
+    )
 
     # Values that have no digits at all (pure text)
-    mask_no_digits = ~s.str.contains(r"\d", regex=True)
+    mask_no_digits = ~s.str.contains(DIGIT_PATTERN, na=False).to_numpy(
+        dtype=bool, na_value=False
+    )
 
     # Consider last 15 rows as footer zone
     last_n = 15
@@ -59,11 +113,52 @@ def clean_ned_column(df, col_name):
     keep_mask = ~(mask_empty_like | mask_footer_text)
 
     df_clean = df.loc[keep_mask].copy()
-    df_clean[col_name] = s.loc[keep_mask]
+    df_clean[col_name] = s[keep_mask]
 
     return df_clean
 
 
+def factorize_ned(*columns):
+    """
+    Encode one or more NED columns to shared dense int64 codes in a single
+    factorize pass. Missing values get a code of their own, so every code
+    lies in [0, n_codes).
+    Returns (one code array per input column, n_codes).
+    """
+    values = pd.concat(
+        [pd.Series(c).reset_index(drop=True) for c in columns], ignore_index=True
+    )
+    codes, uniques = values.factorize(use_na_sentinel=False)
+    codes = codes.astype(np.int64)
+    splits = np.split(codes, np.cumsum([len(c) for c in columns])[:-1])
+    return splits, len(uniques)
+
+
+def has_duplicates(column):
+    """Whether any value occurs more than once in a NED column."""
+    # factorize already counted the distinct values
+    (codes,), n_codes = factorize_ned(column)
+    return len(codes) != n_codes
+
+
+def as_arrow_strings(s):
+    """Convert a text column to Arrow-backed strings; leave others as-is."""
+    if pd.api.types.is_string_dtype(s):
+        return s.astype(ARROW_STRING)
+    return s
+
+
+def constant_column(value, index):
+    """
+    Broadcast a scalar user input over an index as a one-category
+    categorical: a single stored value plus int8 codes per row.
+    """
+    codes = np.zeros(len(index), dtype=np.int8)
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories=[value]), index=index
+    )
+
+
 # --------- Helpers to read/write per-session files and data ---------
 
 def get_job_id():
@@ -80,27 +175,139 @@ def get_path(name):
     return os.path.join(TMP_DIR, filename)
 
 
+def read_excel(source):
+    """Read an Excel file with the fastest available engine."""
+    return pd.read_excel(source, engine=EXCEL_READ_ENGINE)
+
+
+def hash_file(path, chunk_size=8 << 20):
+    """Short sha256 of a file's content, read in 8 MB chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def read_upload(path):
+    """
+    Parse an uploaded workbook, reusing an earlier parse of identical
+    content. Returns (content_hash, df).
+    """
+    key = hash_file(path)
+    with PARSE_CACHE_LOCK:
+        df = PARSE_CACHE.get(key)
+        if df is not None:
+            PARSE_CACHE.move_to_end(key)
+            return key, df
+
+    df = read_excel(path)
+    with PARSE_CACHE_LOCK:
+        PARSE_CACHE[key] = df
+        while len(PARSE_CACHE) > MAX_PARSE_CACHE:
+            PARSE_CACHE.popitem(last=False)
+    return key, df
+
+
+def load_clean_df(raw_name, file_hash, col_name):
+    """
+    Cleaned version of a raw upload for the chosen NED column, reusing an
+    earlier clean of the same content and column when available.
+    """
+    key = (file_hash, col_name)
+    if file_hash is not None:
+        with CLEAN_CACHE_LOCK:
+            df = CLEAN_CACHE.get(key)
+            if df is not None:
+                CLEAN_CACHE.move_to_end(key)
+                return df
+
+    df = clean_ned_column(load_df(raw_name), col_name)
+    if file_hash is not None:
+        with CLEAN_CACHE_LOCK:
+            CLEAN_CACHE[key] = df
+            while len(CLEAN_CACHE) > MAX_CLEAN_CACHE:
+                CLEAN_CACHE.popitem(last=False)
+    return df
+
+
+def spool_upload(file_storage):
+    """Write an uploaded file to a temp file on disk and return its path."""
+    suffix = os.path.splitext(file_storage.filename or "")[1] or ".xlsx"
+    tmp = NamedTemporaryFile(delete=False, suffix=suffix, dir=TMP_DIR)
+    tmp.close()
+    try:
+        file_storage.save(tmp.name)
+    except BaseException:
+        os.remove(tmp.name)
+        raise
+    return tmp.name
+
+
+def job_cache_entry(job_id):
+    """
+    Return the cached dataframes for a job, marking it most recently used
+    and evicting the oldest jobs beyond MAX_CACHED_JOBS.
+    Caller must hold JOB_CACHE_LOCK.
+    """
+    entry = JOB_CACHE.setdefault(job_id, {})
+    JOB_CACHE.move_to_end(job_id)
+    while len(JOB_CACHE) > MAX_CACHED_JOBS:
+        JOB_CACHE.popitem(last=False)
+    return entry
+
+
 def save_df(df, name):
-    """Save a dataframe for this session."""
+    """Save a dataframe for this session (disk + in-process cache)."""
     path = get_path(name)
     df.to_excel(path, index=False)
+    version = uuid.uuid4().hex
+    session[f"version_{name}"] = version
+    with JOB_CACHE_LOCK:
+        job_cache_entry(get_job_id())[name] = (version, df)
     return path
 
 
 def load_df(name):
-    """Load a dataframe for this session."""
+    """Load a dataframe for this session, from cache when still current."""
+    job_id = get_job_id()
+    version = session.get(f"version_{name}")
+    with JOB_CACHE_LOCK:
+        cached = job_cache_entry(job_id).get(name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
     path = get_path(name)
-    return pd.read_excel(path)
+    df = read_excel(path)
+    with JOB_CACHE_LOCK:
+        job_cache_entry(job_id)[name] = (version, df)
+    return df
 
 
-def save_duplicate_workbook(output_bytesio):
-    """Save duplicate-highlight workbook for this session."""
-    job_id = get_job_id()
-    filename = f"{job_id}_duplicates.xlsx"
-    path = os.path.join(TMP_DIR, filename)
-    with open(path, "wb") as f:
-        f.write(output_bytesio.getvalue())
-    session["duplicate_path"] = path
+def highlight_duplicates(worksheet, df, col_name, cell_format):
+    """
+    Add a conditional format that fills duplicate values in a column.
+    Excel's built-in "duplicate" rule ignores case, so the app's
+    case-sensitive check is mirrored with EXACT. Each cell first runs a
+    native COUNTIF over the column (escaped so wildcards and operators in
+    values match literally); the O(n) SUMPRODUCT(EXACT) scan only runs for
+    cells that COUNTIF already matched more than once. The rule is one
+    entry in the XML, but Excel still evaluates it per cell, so a sheet
+    with many case-insensitive repeats stays O(n^2) to recalculate.
+    """
+    col_idx = df.columns.get_loc(col_name)
+    col = xl_col_to_name(col_idx)
+    last_row = len(df)
+    rng = f"${col}$2:${col}${last_row + 1}"
+    literal = f'SUBSTITUTE(SUBSTITUTE(SUBSTITUTE({col}2,"~","~~"),"*","~*"),"?","~?")'
+    criteria = (
+        f'=IF(COUNTIF({rng},"="&{literal})>1,'
+        f"SUMPRODUCT(--EXACT({rng},{col}2))>1,FALSE)"
+    )
+    worksheet.conditional_format(
+        1, col_idx, last_row, col_idx,
+        {"type": "formula", "criteria": criteria, "format": cell_format},
+    )
 
 
 # ---------------- STEP 1 : UPLOAD ----------------
@@ -109,14 +316,28 @@ def save_duplicate_workbook(output_bytesio):
 def upload():
     if request.method == "POST":
         # Reset job and simple session data
+        old_job_id = session.get("job_id")
+        if old_job_id is not None:
+            with JOB_CACHE_LOCK:
+                JOB_CACHE.pop(old_job_id, None)
         session.clear()
         job_id = get_job_id()
 
-        pob_file = request.files["pob"]
-        portal_file = request.files["portal"]
+        spooled = []
+        try:
+            pob_path = spool_upload(request.files["pob"])
+            spooled.append(pob_path)
+            portal_path = spool_upload(request.files["portal"])
+            spooled.append(portal_path)
+
+            pob_hash, pob_df = read_upload(pob_path)
+            portal_hash, portal_df = read_upload(portal_path)
+        finally:
+            for path in spooled:
+                os.remove(path)
 
-        pob_df = pd.read_excel(pob_file)
-        portal_df = pd.read_excel(portal_file)
+        session["pob_hash"] = pob_hash
+        session["portal_hash"] = portal_hash
 
         # Store column names only (lightweight) in session
         session["pob_cols"] = list(pob_df.columns)
@@ -147,15 +368,13 @@ def select_columns():
         session["portal_ned"] = request.form["portal_ned"]
         session["portal_name"] = request.form["portal_name"]
 
-        # Load raw data, clean selected NED columns, save cleaned versions
-        pob_df = load_df("pob_raw")
-        portal_df = load_df("portal_raw")
-
-        pob_ned = session["pob_ned"]
-        portal_ned = session["portal_ned"]
-
-        pob_df_clean = clean_ned_column(pob_df, pob_ned)
-        portal_df_clean = clean_ned_column(portal_df, portal_ned)
+        # Clean selected NED columns (cached per upload), save cleaned versions
+        pob_df_clean = load_clean_df(
+            "pob_raw", session.get("pob_hash"), session["pob_ned"]
+        )
+        portal_df_clean = load_clean_df(
+            "portal_raw", session.get("portal_hash"), session["portal_ned"]
+        )
 
         save_df(pob_df_clean, "pob_clean")
         save_df(portal_df_clean, "portal_clean")
@@ -182,43 +401,32 @@ def check_duplicates():
     pob = load_df("pob_clean")
     portal = load_df("portal_clean")
 
-    pob_dup_mask = pob[pob_ned].duplicated(keep=False)
-    portal_dup_mask = portal[portal_ned].duplicated(keep=False)
-
-    pob_dup = pob_dup_mask.any()
-    portal_dup = portal_dup_mask.any()
+    # Only the yes/no answer is needed here; the highlighting itself is a
+    # conditional format, so no per-row duplicate mask is built
+    pob_dup = has_duplicates(pob[pob_ned])
+    portal_dup = has_duplicates(portal[portal_ned])
 
     if pob_dup or portal_dup:
-        # Build Excel file with duplicate NED cells highlighted
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        # Build Excel file with duplicate NED cells highlighted.
+        # A conditional format per sheet lets Excel do the colouring,
+        # instead of styling each duplicate cell here.
+        # Written straight to the job's file so no in-memory buffer grows
+        duplicate_path = get_path("duplicates")
+        with pd.ExcelWriter(duplicate_path, engine="xlsxwriter") as writer:
             pob.to_excel(writer, sheet_name="POB", index=False)
             portal.to_excel(writer, sheet_name="PORTAL", index=False)
 
-            wb = writer.book
-            pob_ws = wb["POB"]
-            portal_ws = wb["PORTAL"]
-
-            yellow_fill = PatternFill(
-                start_color="FFFF00",
-                end_color="FFFF00",
-                fill_type="solid",
-            )
-
-            # POB duplicates
-            pob_ned_idx = pob.columns.get_loc(pob_ned) + 1
-            for i, is_dup in enumerate(pob_dup_mask, start=2):
-                if is_dup:
-                    pob_ws.cell(row=i, column=pob_ned_idx).fill = yellow_fill
+            yellow_fmt = writer.book.add_format({"bg_color": "#FFFF00"})
 
-            # PORTAL duplicates
-            portal_ned_idx = portal.columns.get_loc(portal_ned) + 1
-            for i, is_dup in enumerate(portal_dup_mask, start=2):
-                if is_dup:
-                    portal_ws.cell(row=i, column=portal_ned_idx).fill = yellow_fill
+            # Only sheets that actually have duplicates get the rule
+            if pob_dup:
+                highlight_duplicates(writer.sheets["POB"], pob, pob_ned, yellow_fmt)
+            if portal_dup:
+                highlight_duplicates(
+                    writer.sheets["PORTAL"], portal, portal_ned, yellow_fmt
+                )
 
-        output.seek(0)
-        save_duplicate_workbook(output)
+        session["duplicate_path"] = duplicate_path
 
         return render_template(
             "duplicate_warning.html",
@@ -278,8 +486,19 @@ def generate():
     pob = load_df("pob_clean")
     portal = load_df("portal_clean")
 
-    missing_in_portal = pob[~pob[pob_ned].isin(portal[portal_ned])]
-    missing_in_pob = portal[~portal[portal_ned].isin(pob[pob_ned])]
+    # Shared dense codes in [0, n_codes) for both columns
+    (pob_codes, portal_codes), n_codes = factorize_ned(
+        pob[pob_ned], portal[portal_ned]
+    )
+
+    # Presence tables indexed by code: membership without any hashing
+    in_pob = np.zeros(n_codes, dtype=bool)
+    in_pob[pob_codes] = True
+    in_portal = np.zeros(n_codes, dtype=bool)
+    in_portal[portal_codes] = True
+
+    missing_in_portal = pob.iloc[np.flatnonzero(~in_portal[pob_codes])]
+    missing_in_pob = portal.iloc[np.flatnonzero(~in_pob[portal_codes])]
 
     manifest_count = len(missing_in_portal)
     return_count = len(missing_in_pob)
@@ -287,48 +506,54 @@ def generate():
     session["manifest_count"] = manifest_count
     session["return_count"] = return_count
 
+    rfm_index = missing_in_portal.index
+    return_index = missing_in_pob.index
+
     # RFM
     rfm = pd.DataFrame({
-        "Passenger Category": inputs["rfm_category"],
+        "Passenger Category": constant_column(inputs["rfm_category"], rfm_index),
         "NED Pass No.": missing_in_portal[pob_ned],
-        "Travelling Vendor Code": inputs["vendor_code"],
-        "Vendor Name": inputs["vendor_name"],
-        "Vendor Employee Name": missing_in_portal[pob_name],
-        "Gender": inputs["gender"],
-        "Designation": "",
-        "Originating Point": inputs["rfm_origin"],
-        "Destination Point": inputs["rfm_destination"],
-        "": "",
-        "Charge": inputs["charge"],
+        "Travelling Vendor Code": constant_column(inputs["vendor_code"], rfm_index),
+        "Vendor Name": constant_column(inputs["vendor_name"], rfm_index),
+        "Vendor Employee Name": as_arrow_strings(missing_in_portal[pob_name]),
+        "Gender": constant_column(inputs["gender"], rfm_index),
+        "Designation": constant_column("", rfm_index),
+        "Originating Point": constant_column(inputs["rfm_origin"], rfm_index),
+        "Destination Point": constant_column(inputs["rfm_destination"], rfm_index),
+        "": constant_column("", rfm_index),
+        "Charge": constant_column(inputs["charge"], rfm_index),
     })
 
     # Manifest
     manifest = pd.DataFrame({
-        "Passenger Weight": inputs["passenger_weight"],
-        "Baggage Weight": inputs["baggage_weight"],
-        "": "",
-        " ": "",
-        "  ": "",
-        "Time Reported": inputs["time_reported"],
+        "Passenger Weight": constant_column(inputs["passenger_weight"], rfm_index),
+        "Baggage Weight": constant_column(inputs["baggage_weight"], rfm_index),
+        "": constant_column("", rfm_index),
+        " ": constant_column("", rfm_index),
+        "  ": constant_column("", rfm_index),
+        "Time Reported": constant_column(inputs["time_reported"], rfm_index),
     }, index=rfm.index)
 
     # Return Manifest
     return_manifest = pd.DataFrame({
-        "Passenger Category": inputs["return_category"],
+        "Passenger Category": constant_column(inputs["return_category"], return_index),
         "Smart Card No.": missing_in_pob[portal_ned],
-        "Supplier": inputs["supplier"],
-        "Vendor Employee Name": missing_in_pob[portal_name],
-        "Gender": inputs["gender"],
-        "Designation": "",
-        "": "",
-        "Charge": inputs["charge"],
-        "Pax wt.": inputs["passenger_weight"],
-        "Baggage": inputs["baggage_weight"],
-        "Originating Point": inputs["return_origin"],
-        "Destination Point": inputs["return_destination"],
+        "Supplier": constant_column(inputs["supplier"], return_index),
+        "Vendor Employee Name": as_arrow_strings(missing_in_pob[portal_name]),
+        "Gender": constant_column(inputs["gender"], return_index),
+        "Designation": constant_column("", return_index),
+        "": constant_column("", return_index),
+        "Charge": constant_column(inputs["charge"], return_index),
+        "Pax wt.": constant_column(inputs["passenger_weight"], return_index),
+        "Baggage": constant_column(inputs["baggage_weight"], return_index),
+        "Originating Point": constant_column(inputs["return_origin"], return_index),
+        "Destination Point": constant_column(
+            inputs["return_destination"], return_index
+        ),
     })
 
-    # Save final dataframes for this session
+    # Save final dataframes for this session; any built download is stale
+    session.pop("final_output_path", None)
     save_df(rfm, "rfm_final")
     save_df(manifest, "manifest_final")
     save_df(return_manifest, "return_manifest_final")
@@ -344,20 +569,25 @@ def generate():
 
 @app.route("/download")
 def download():
-    # Load per-session final dataframes
-    rfm = load_df("rfm_final")
-    manifest = load_df("manifest_final")
-    return_manifest = load_df("return_manifest_final")
-
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        rfm.to_excel(writer, index=False, sheet_name="RFM")
-        manifest.to_excel(writer, index=False, sheet_name="Manifest")
-        return_manifest.to_excel(writer, index=False, sheet_name="Return Manifest")
-    output.seek(0)
+    # Serve the workbook built by an earlier download of the same result
+    path = session.get("final_output_path")
+    if not path or not os.path.exists(path):
+        # Load per-session final dataframes
+        rfm = load_df("rfm_final")
+        manifest = load_df("manifest_final")
+        return_manifest = load_df("return_manifest_final")
+
+        path = get_path("final_output")
+        with pd.ExcelWriter(path, engine="xlsxwriter") as writer:
+            rfm.to_excel(writer, index=False, sheet_name="RFM")
+            manifest.to_excel(writer, index=False, sheet_name="Manifest")
+            return_manifest.to_excel(
+                writer, index=False, sheet_name="Return Manifest"
+            )
+        session["final_output_path"] = path
 
     return send_file(
-        output,
+        path,
         download_name="Final_Output.xlsx",
         as_attachment=True,
     )